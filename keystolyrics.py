@@ -25,20 +25,13 @@ Expected notes.chart format:
 """
 
 import re
-from operator import attrgetter
-from collections import deque
-
-class ChartEvent:
-	def __init__(self, time, name):
-		self.time = int(time)
-		self.name = name
-	
-	def get_code(self):
-		return '  {} = E "{}"'.format(self.time, self.name)
+from operator import itemgetter
 
 # Regexes used in parsing lyric files
-word_boundary = re.compile(r"\s+")
-syllable_boundary = re.compile(r"-")
+
+# Matches each syllable in a line, keeping the dash which joins it to the rest of its word
+# A word ending in a dash is followed by an empty syllable
+syllable = re.compile(r"[^\s-]*-|[^\s-]+|(?<=-)(?!\S)")
 
 blank_line = re.compile(r"\s*\n")
 
@@ -49,13 +42,17 @@ class LyricFile:
 
 		"line",
 		"syllable_buffer",
+		"syllable_index",
 	]
 
 	def __init__(self, path):
 		self.file = open(path)
 
 		self.line = 0
-		self.syllable_buffer = deque()
+
+		# Syllables of the current line, and the index of the next one to be used
+		self.syllable_buffer = []
+		self.syllable_index = 0
 	
 	# Read the next line of syllables from the file. This should coincide with phrase_start events.
 	def start_line(self, expect_eof=False):
@@ -74,70 +71,44 @@ class LyricFile:
 			else:
 				raise Exception("Not enough lines in lyric file")
 
-		line = line.strip()
-
-		# Nested list of syllables in each word
-		words = [syllable_boundary.split(word) for word in word_boundary.split(line)]
+		syllables = syllable.findall(line.strip())
 
-		# Append dashes to syllables
-		for word in words:
-			for i in range(0, len(word) - 1):
-				word[i] += "-"
+		# Keep any syllables left over from the previous line
+		if self.syllable_index < len(self.syllable_buffer):
+			syllables = self.syllable_buffer[self.syllable_index:] + syllables
 
-		# Flatten the list
-		self.syllable_buffer.extend(s for w in words for s in w)
+		self.syllable_buffer = syllables
+		self.syllable_index = 0
 
 	# Fetch the next syllable from the lyric file
 	def next_syllable(self):
-		if len(self.syllable_buffer) <= 0:
+		i = self.syllable_index
+		if i >= len(self.syllable_buffer):
 			raise Exception(f"Line {self.line} in the lyric file is too short")
 
-		return self.syllable_buffer.popleft()
+		self.syllable_index = i + 1
+		return self.syllable_buffer[i]
 
 	# Check that a line has ended when it should. This should coincide with phrase_end events
 	def end_line(self):
-		if len(self.syllable_buffer) > 0:
+		if self.syllable_index < len(self.syllable_buffer):
 			raise Exception(f"Line {self.line} of the lyric file ended too early")
 
 	# Checks if the file has reached the end. Throws an error if not
 	def end_file(self):
-		if len(self.syllable_buffer) > 0:
+		if self.syllable_index < len(self.syllable_buffer):
 			raise Exception("Too many syllables on final line of the lyric file")
 
 		ln = self.line
 		self.start_line(expect_eof=True)
-		if len(self.syllable_buffer) > 0:
+		if self.syllable_index < len(self.syllable_buffer):
 			raise Exception(f"Unused lines in lyric file. Song ended after line {ln}")
 
 	def close(self):
 		self.file.close()
 
-# Dummy class following the same interface as LyricFile
-# Used when no lyric file is given
-class DummyLyricFile:
-	def __init__(self, path=None):
-		pass
-
-	def start_line(self):
-		pass
-
-	def next_syllable(self):
-		return ""
-
-	def end_line(self):
-		pass
-
-	def end_file(self):
-		pass
-
-	def close(self):
-		pass
-
 # Regexes used in parsing chart files
 
-# Section Headers
-events_header = re.compile(r"\s*\[Events\]\s*")
-
 # Matches an event from the Events section
 event_line = re.compile(r'\s*(\d+)\s*=\s*E\s*"([^"]*)"\s*')
 
@@ -149,113 +120,165 @@ lyric_note_line = re.compile(r'\s*(\d+)\s*=\s*N\s*([1-3])\s*\d+\s*')
 #                     6329 = E solo
 any_note_line = re.compile(r'\s*\d+\s*=\s*(?:[NS]\s*\d+\s*\d+|E\s*[a-zA-Z\d_]+)\s*')
 
+# States used by convert_chart while scanning the chart file
+#  0: Before the Events section
+#  1: Expecting the open brace of the Events section
+#  2: Reading events
+#  3: Between Events and the lyric chart
+#  4: Expecting the open brace of the lyric chart
+#  5: Reading notes from the lyric chart
+#  6: Finished reading the lyric chart
+
+# lyric_file may be None if no lyric file was given, in which case lyric events are left empty
 def convert_chart(file_in, file_out, lyric_file, chart="ExpertKeyboard"):
-	# Echo stuff before events
-	while True:
-		line = file_in.readline()
-		if line == "":
-			raise Exception("Chart has no Events Section")
-		
-		if events_header.fullmatch(line):
-			break
-		
-		file_out.write(line)
-	
-	# Read in current events
-	open_brace_line = file_in.readline()
-	if open_brace_line.strip() != "{":
-		raise Exception('Line after "[Events]" should contain only "{"')
-	
+	lyric_chart_header = f"[{chart}]"
+	match_event = event_line.fullmatch
+	match_lyric_note = lyric_note_line.fullmatch
+	match_any_note = any_note_line.fullmatch
+
+	# Events are stored as (time, name) tuples
 	global_events = []
-	while True:
-		line = file_in.readline()
-		if line == "":
-			raise Exception("Unexpected EOF during events section")
-		event_match = event_line.fullmatch(line)
-		
-		if event_match:
-			event = ChartEvent(event_match[1], event_match[2])
-			global_events.append(event)
-		elif line.strip() == "}":
-			break
-		else:
-			raise Exception("Unexpected line in Events section: " + line)
-	
-	# Read and store diffs before ExpertKeyboard
-	lyric_chart_header = re.compile(rf"\s*\[{chart}\]\s*")
-	diff_text = ""
-	while True:
-		line = file_in.readline()
-		if line == "":
-			raise Exception("File has no ExpertKeyboard chart to convert")
-		
-		if lyric_chart_header.fullmatch(line):
-			break
-		
-		diff_text += line
-	
-	# when we find ExpertKeyboard:
-	# read in the notes, converting them to lyric events
-	open_brace_line = file_in.readline()
-	if open_brace_line.strip() != "{":
-		raise Exception('Line after "[ExpertKeyboard]" should contain only "{"')
-	
-	while True:
-		line = file_in.readline()
-		if line == "":
-			raise Exception("Unexpected EOF during ExpertKeyboard chart")
-		
-		# If it's a valid note, on an appropriate fret, log the relevant event
-		# Matches a line like: 6912 = N 2 0
-		# Only the timestamp (6912) and fret id (2) are captured
-		note_match = lyric_note_line.fullmatch(line)
-		if note_match:
-			event_type = None
-			if note_match[2] == "1":
-				lyric_file.start_line()
+
+	# Bound methods used for every line in the Events section and lyric chart
+	add_event = global_events.append
+	if lyric_file is not None:
+		next_syllable = lyric_file.next_syllable
+
+	# Read the whole chart at once, rather than a line at a time
+	lines = file_in.readlines()
+
+	# Lines other than the Events section and lyric chart are echoed unchanged
+	# Their positions are noted so they can be copied over as whole slices
+	state = 0
+	for i, line in enumerate(lines):
+		# The lyric chart makes up most of the file, so check for it first
+		if state == 5:
+			# Most lines are notes or star power spaced like: 6912 = N 2 0
+			# These can be picked apart without a regex
+			tokens = line.split()
+			if (len(tokens) == 5 and tokens[1] == "="
+					and tokens[0].isdecimal() and tokens[3].isdecimal() and tokens[4].isdecimal()):
+				line_type = tokens[2]
+			else:
+				line_type = None
+
+			if line_type == "N":
+				time = tokens[0]
+				fret = tokens[3]
+
+			elif line_type == "S":
+				# Star power etc, ignore it
+				continue
+
+			elif tokens == ["}"]:
+				# If it's a closing brace, the chart is finished
+				if lyric_file is not None:
+					lyric_file.end_file()
+				state = 6
+				break
+
+			else:
+				# Fall back to the regexes for other spacing, and for events
+				# Only matches notes on an appropriate fret
+				# Only the timestamp (6912) and fret id (2) are captured
+				note_match = match_lyric_note(line)
+				if not note_match:
+					# If it's any other note, or star power etc, ignore it
+					if match_any_note(line):
+						continue
+
+					# If it's anything else, throw an error
+					raise Exception("Unexpected line during ExpertKeyboard chart: " + line)
+
+				time = note_match[1]
+				fret = note_match[2]
+
+			# If it's on an appropriate fret, log the relevant event
+			# Lyrics are the most common, so are checked first
+			if fret == "2":
+				if lyric_file is not None:
+					event_type = "lyric " + next_syllable()
+				else:
+					event_type = "lyric "
+			elif fret == "1":
+				if lyric_file is not None:
+					lyric_file.start_line()
 				event_type = "phrase_start"
-			elif note_match[2] == "2":
-				event_type = "lyric " + lyric_file.next_syllable()
-			elif note_match[2] == "3":
-				lyric_file.end_line()
+			elif fret == "3":
+				if lyric_file is not None:
+					lyric_file.end_line()
 				event_type = "phrase_end"
+			else:
+				# Note on another fret, ignore it
+				continue
 			
-			event = ChartEvent(note_match[1], event_type)
-			global_events.append(event)
-			continue
-		
-		# If it's any other note, or star power etc, ignore it
-		if any_note_line.fullmatch(line):
-			continue
-		
-		# If it's a closing brace, break
-		if line.strip() == "}":
-			break
-		
-		# If it's anything else, throw an error
-		raise Exception("Unexpected line during ExpertKeyboard chart: " + line)
-
-	lyric_file.end_file()
-
-	# Read and store any diffs after ExpertKeyboard
-	while True:
-		line = file_in.readline()
-		if line == "":
-			break
-		
-		diff_text += line
+			add_event((int(time), event_type))
+
+		elif state == 0:
+			if line.strip() == "[Events]":
+				events_start = i
+				state = 1
+
+		elif state == 1:
+			if line.strip() != "{":
+				raise Exception('Line after "[Events]" should contain only "{"')
+			state = 2
+
+		elif state == 2:
+			# Read in current events
+			event_match = match_event(line)
+			
+			if event_match:
+				add_event((int(event_match[1]), event_match[2]))
+			elif line.strip() == "}":
+				diffs_start = i + 1
+				state = 3
+			else:
+				raise Exception("Unexpected line in Events section: " + line)
+
+		elif state == 3:
+			# Skip over diffs before ExpertKeyboard, until we find ExpertKeyboard
+			if line.strip() == lyric_chart_header:
+				diffs_end = i
+				state = 4
+
+		elif state == 4:
+			if line.strip() != "{":
+				raise Exception('Line after "[ExpertKeyboard]" should contain only "{"')
+			state = 5
+
+	# Check the file didn't end early
+	if state == 0:
+		raise Exception("Chart has no Events Section")
+	elif state == 1:
+		raise Exception('Line after "[Events]" should contain only "{"')
+	elif state == 2:
+		raise Exception("Unexpected EOF during events section")
+	elif state == 3:
+		raise Exception("File has no ExpertKeyboard chart to convert")
+	elif state == 4:
+		raise Exception('Line after "[ExpertKeyboard]" should contain only "{"')
+	elif state == 5:
+		raise Exception("Unexpected EOF during ExpertKeyboard chart")
 	
 	# compile the existing events plus the new lyric events
-	global_events = sorted(global_events, key=attrgetter("time"))
-	
-	# Print the events section
-	file_out.write("[Events]\n{\n")
-	for event in global_events:
-		file_out.write(event.get_code() + "\n")
-	file_out.write("}\n")
+	# Sort on time only. The sort is stable, so events at the same time keep their file order
+	# Both sections are normally already in time order, which the sort detects and merges in
+	# linear time, while still coping with charts that aren't
+	global_events.sort(key=itemgetter(0))
 	
-	# Print previously stored diffs
-	file_out.write(diff_text)
+	# Build the whole output, then write it at once
+	# Stuff from before events, then the events section, then the diffs before and after
+	# the lyric chart
+	output = lines[:events_start]
+	output.append("[Events]\n{\n")
+	output.extend(f'  {time} = E "{name}"\n' for time, name in global_events)
+	output.append("}\n")
+	output.extend(lines[diffs_start:diffs_end])
+	# The loop stopped at the closing brace of the lyric chart
+	output.extend(lines[i + 1:])
+
+	file_out.write("".join(output))
 
 if __name__ == "__main__":
 	import sys
@@ -281,11 +304,14 @@ if __name__ == "__main__":
 	if args.lyrics is not None:
 		lyric_file = LyricFile(args.lyrics)
 	else:
-		lyric_file = DummyLyricFile()
+		lyric_file = None
 
 	files_closable = False
 	created_backup = False
 
+	# Charts can be tens of thousands of lines, so read and write in large blocks
+	buffer_size = 1 << 20
+
 	if input_path is None:
 		# No files specified, use stdin and stdout
 		file_in = sys.stdin
@@ -299,14 +325,14 @@ if __name__ == "__main__":
 		shutil.move(output_path, input_path)
 		created_backup = True
 
-		file_in = open(input_path)
-		file_out = open(output_path, "w")
+		file_in = open(input_path, buffering=buffer_size)
+		file_out = open(output_path, "w", buffering=buffer_size)
 		files_closable = True
 	
 	else:
 		# Two files specified, use those locations
-		file_in = open(input_path)
-		file_out = open(output_path, "w")
+		file_in = open(input_path, buffering=buffer_size)
+		file_out = open(output_path, "w", buffering=buffer_size)
 		files_closable = True
 
 	try:
@@ -319,7 +345,8 @@ if __name__ == "__main__":
 			file_in.close()
 			file_out.close()
 
-		lyric_file.close()
+		if lyric_file is not None:
+			lyric_file.close()
 
 		if err:
 			os.remove(output_path)